@@ -1,14 +1,21 @@
 import asyncio
+import contextlib
+import hashlib
 import json
+import logging
+import logging.handlers
 import re
-from typing import TypedDict, Annotated, List, Dict, Any, operator
+import shelve
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict, AsyncIterator, List, Dict, Any, Set, Tuple
 
-from langchain_core.messages import ToolMessage, AIMessage, BaseMessage
+import orjson
 from langchain_core.tools import BaseTool
 from langchain_ollama import ChatOllama
-from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain.chat_models import init_chat_model
 from speaker import speaker
 from voice_recognizer import listen_for_command
@@ -16,71 +23,306 @@ from voice_recognizer import listen_for_command
 
 class MissionState(TypedDict):
     user_prompt: str
-    mission_plan: List[Dict[str, Any]]
-    messages: Annotated[List[BaseMessage], operator.add]
-    current_step_index: int
-    target_location_details: Dict[str, Any]
     tool_schemas: str
+    tool_names: Set[str]
 
 import os 
 from dotenv import load_dotenv
 load_dotenv()
 
+# Records are buffered and written in batches; anything at INFO or above flushes immediately,
+# so only the verbose per-step DEBUG dumps are held back.
+log = logging.getLogger("drone_agent")
+log.setLevel(logging.DEBUG)
+log.addHandler(logging.handlers.MemoryHandler(capacity=100, flushLevel=logging.INFO, target=logging.StreamHandler(sys.stderr)))
+log.propagate = False
 
-LLM = init_chat_model("groq:llama3-8b-8192")
-#LLM = ChatOllama(model="llama3.1:latest")
 
-def extract_json_from_string(text: str) -> list:
+# JSON mode makes the model return a bare JSON object, so no markdown extraction is needed.
+LLM = init_chat_model("groq:llama3-8b-8192").bind(response_format={"type": "json_object"})
+# Local fallback: a 4-bit quantized build roughly doubles tokens/sec on CPUs and small GPUs,
+# and the short JSON plan fits easily in a 2k context with a capped output length.
+#LLM = ChatOllama(model="llama3.1:8b-instruct-q4_K_M", format="json", num_ctx=2048, num_predict=512, temperature=0)
+
+# Parsed mission plans are persisted here so repeated commands skip the LLM round-trip.
+PLAN_CACHE_PATH = "planner_cache.db"
+
+
+def plan_cache_key(tool_schemas: str, user_prompt: str) -> str:
+    """
+    Builds the cache key for a mission plan. The prompt is normalized so that
+    commands differing only in case or surrounding whitespace share an entry,
+    and the tool schemas are included so a changed toolset never reuses a stale plan.
+    """
+    normalized_prompt = user_prompt.strip().lower()
+    return hashlib.sha256(f"{tool_schemas}\n{normalized_prompt}".encode()).hexdigest()
+
+def forget_cached_plan(cache_key: str):
+    """Drops a cached mission plan that turned out to be unusable, so the LLM plans it afresh."""
+    with shelve.open(PLAN_CACHE_PATH) as cache:
+        cache.pop(cache_key, None)
+
+# A mission step. The LLM emits each step as a compact [tool, args] pair.
+Step = namedtuple("Step", "tool args")
+
+def to_step(raw: Any) -> Step | None:
+    """
+    Converts a decoded plan entry into a Step. Accepts the compact [tool, args]
+    pair as well as the older {"tool": ..., "args": ...} object, which may still
+    be found in the plan cache. Returns None for malformed entries.
+    """
+    if isinstance(raw, Step):
+        return raw
+    if isinstance(raw, dict) and isinstance(raw.get("tool"), str):
+        args = raw.get("args")
+        return Step(raw["tool"], args if isinstance(args, dict) else {})
+    if isinstance(raw, (list, tuple)) and raw and isinstance(raw[0], str):
+        args = raw[1] if len(raw) > 1 and isinstance(raw[1], dict) else {}
+        return Step(raw[0], args)
+    log.error("Error: Ignoring malformed plan step: %s", raw)
+    return None
+
+def to_steps(raw_plan: Any) -> List[Step]:
+    if not isinstance(raw_plan, list):
+        return []
+    return [step for step in map(to_step, raw_plan) if step is not None]
+
+def format_plan(mission_plan: List[Step]) -> str:
+    return orjson.dumps([list(step) for step in mission_plan], option=orjson.OPT_INDENT_2).decode()
+
+_JSON_DECODER = json.JSONDecoder()
+
+def extract_json_from_string(text: str) -> List[Step]:
     """
-    More robustly extracts a JSON list from a string. It first checks for a
-    markdown block, but if that fails, it finds the first '[' and the last ']'
-    to capture the list, making it resilient to formatting errors from the LLM.
+    Extracts the list of plan steps from a string in a single forward pass. If the LLM used a
+    markdown block, only its contents are decoded; otherwise decoding starts at the
+    first '['. raw_decode stops at the end of the list, so trailing prose from the
+    LLM is ignored instead of breaking the parse.
     """
-   
-    match = re.search(r"```json\s*([\s\S]*?)\s*```", text)
-    if match:
-        json_str = match.group(1)
+    _, fence, fenced = text.partition("```json")
+    if fence:
+        text = fenced.partition("```")[0]
+        start_index = len(text) - len(text.lstrip())
     else:
-        
-        try:
-            start_index = text.find('[')
-            end_index = text.rfind(']')
-            if start_index != -1 and end_index != -1 and end_index > start_index:
-                json_str = text[start_index : end_index + 1]
-            else:
-                return [] 
-        except Exception:
+        start_index = text.find('[')
+        if start_index == -1:
             return []
 
-   
     try:
-        parsed = json.loads(json_str)
+        parsed, _ = _JSON_DECODER.raw_decode(text, start_index)
         # Handle cases where the LLM might double-encode the JSON
         if isinstance(parsed, str):
-            return json.loads(parsed)
-        return parsed
+            parsed, _ = _JSON_DECODER.raw_decode(parsed.strip())
+        return to_steps(parsed)
     except json.JSONDecodeError:
-        print(f"Error: Failed to decode JSON from string snippet: {json_str}")
+        log.error("Error: Failed to decode JSON from string snippet: %s", text[start_index:])
         return []
 
-def format_tools_for_prompt(tools: list[BaseTool]) -> str:
-    schemas = []
-    for tool in tools:
+class PlanStreamParser:
+    """
+    Incrementally scans streamed LLM output and returns each mission step as soon
+    as its JSON value is complete. A step is the outermost [tool, args] pair (or
+    legacy object) found inside a list, so both the {"plan": [...]} object and a
+    bare list are handled.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self._position = 0
+        self._open_brackets = []
+        self._in_string = False
+        self._escaped = False
+        self._step_start = None
+        self._step_depth = 0
+
+    def feed(self, chunk: str) -> List[Step]:
+        self.buffer += chunk
+        steps = []
+        for index in range(self._position, len(self.buffer)):
+            char = self.buffer[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '[{':
+                if self._step_start is None and self._open_brackets[-1:] == ['[']:
+                    self._step_start = index
+                    self._step_depth = len(self._open_brackets)
+                self._open_brackets.append(char)
+            elif char in ']}' and self._open_brackets:
+                self._open_brackets.pop()
+                if self._step_start is not None and len(self._open_brackets) == self._step_depth:
+                    step_str = self.buffer[self._step_start : index + 1]
+                    self._step_start = None
+                    try:
+                        step = to_step(orjson.loads(step_str))
+                    except orjson.JSONDecodeError:
+                        log.error("Error: Failed to decode streamed step: %s", step_str)
+                        continue
+                    if step is not None:
+                        steps.append(step)
+        self._position = len(self.buffer)
+        return steps
+
+# Deterministic fast path for canonical commands, so they never wait on the LLM.
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_UNITS = r"(?:\s*(?:m|meters?|metres?))?"
+_TAKEOFF_RE = re.compile(rf"^take\s*off(?:(?: to)? {_NUMBER}{_UNITS})?$")
+_TAKEOFF_AND_LAND_RE = re.compile(rf"^take\s*off(?:(?: to)? {_NUMBER}{_UNITS})?,? (?:and|then) land$")
+_LAND_RE = re.compile(r"^land(?: now| here)?$")
+_RETURN_RE = re.compile(r"^(?:return (?:home|to launch)|go home|go back home|come back|come home|rtl)$")
+_RELATIVE_RE = re.compile(rf"^(?:go|fly|move) (forward|backward|back|left|right|up|down) {_NUMBER}{_UNITS}$")
+# Maps a spoken direction onto the fly_relative argument and its sign.
+_RELATIVE_DIRECTIONS = {
+    "forward": ("forward_meters", 1), "backward": ("forward_meters", -1), "back": ("forward_meters", -1),
+    "right": ("right_meters", 1), "left": ("right_meters", -1),
+    "down": ("down_meters", 1), "up": ("down_meters", -1),
+}
+DEFAULT_TAKEOFF_ALTITUDE = 20.0
+fast_plan_stats = {"hits": 0, "total": 0}
+
+def fast_plan(user_prompt: str) -> List[Step] | None:
+    """
+    Builds the mission plan for trivial commands ("take off", "land", "return home",
+    "go forward 10 meters") directly, without the LLM. Returns None on a miss.
+    """
+    command = " ".join(user_prompt.lower().strip(" .!?").split())
+
+    if match := _TAKEOFF_RE.match(command) or _TAKEOFF_AND_LAND_RE.match(command):
+        altitude = float(match.group(1) or DEFAULT_TAKEOFF_ALTITUDE)
+        if altitude <= 0:
+            # Not a real takeoff; leave it to the LLM rather than arming on the ground.
+            return None
+        plan = [
+            Step("pre_flight_check", {}),
+            Step("arm_and_takeoff", {"altitude_meters": altitude}),
+        ]
+        if match.re is _TAKEOFF_AND_LAND_RE:
+            plan.append(Step("land", {}))
+        return plan
+    if _LAND_RE.match(command):
+        return [Step("land", {})]
+    if _RETURN_RE.match(command):
+        return [Step("return_to_launch", {})]
+    if match := _RELATIVE_RE.match(command):
+        arg_name, sign = _RELATIVE_DIRECTIONS[match.group(1)]
+        return [Step("fly_relative", {arg_name: sign * float(match.group(2))})]
+    return None
+
+# Formatted prompt lines, keyed by tool name, so schema introspection runs once per tool.
+_TOOL_PROMPT_LINES: Dict[str, str] = {}
+
+def format_tool_for_prompt(tool: BaseTool) -> str:
+    if tool.name not in _TOOL_PROMPT_LINES:
         schema = tool.get_input_schema().schema()
         params = ", ".join([f"{name}: {props.get('type')}" for name, props in schema.get('properties', {}).items()])
-        schemas.append(f"- {tool.name}({params}): {tool.description}")
-    return "\n".join(schemas)
+        _TOOL_PROMPT_LINES[tool.name] = f"- {tool.name}({params}): {tool.description}"
+    return _TOOL_PROMPT_LINES[tool.name]
+
+def format_tools_for_prompt(tools: list[BaseTool]) -> str:
+    return "\n".join(format_tool_for_prompt(tool) for tool in tools)
+
 
+# Keeps references to running planner streams so they are not garbage collected.
+_planner_tasks = set()
 
-def planner_node(state: MissionState) -> Dict[str, Any]:
+async def stream_mission_plan(prompt: str, plan_queue: asyncio.Queue, cache_key: str, tool_names: Set[str]):
+    """
+    Streams the LLM response and forwards each mission step to the queue as soon
+    as it is complete, so execution can start while the rest of the plan is still
+    being generated. A None sentinel always marks the end of the plan. Only
+    complete plans whose steps all name known tools are cached.
+    """
+    parser = PlanStreamParser()
+    mission_plan = []
+    try:
+        try:
+            async for chunk in LLM.astream(prompt):
+                for step in parser.feed(chunk.content):
+                    mission_plan.append(step)
+                    await plan_queue.put(step)
+        except Exception as e:
+            if mission_plan:
+                raise
+            # Nothing reached the executor yet, so a single non-streaming request can still deliver the plan.
+            log.warning("Streaming the mission plan failed (%s); retrying without streaming.", e)
+            parser = PlanStreamParser()
+            response = await LLM.ainvoke(prompt)
+            for step in parser.feed(response.content):
+                mission_plan.append(step)
+                await plan_queue.put(step)
+
+        if not mission_plan:
+            # Nothing was streamed as a step (e.g. double-encoded JSON), so parse the full response.
+            try:
+                raw_plan = orjson.loads(parser.buffer)["plan"]
+                if isinstance(raw_plan, str):
+                    raw_plan = orjson.loads(raw_plan)
+                mission_plan = to_steps(raw_plan)
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                pass
+            if not mission_plan:
+                mission_plan = extract_json_from_string(parser.buffer)
+            for step in mission_plan:
+                await plan_queue.put(step)
+
+        if not mission_plan: 
+            log.error("❌ Error: LLM failed to generate a valid mission plan.\nLLM Raw Output:\n%s", parser.buffer)
+        else: 
+            log.info("✅ Generated Mission Plan:\n%s", format_plan(mission_plan))
+            unknown_tools = [step.tool for step in mission_plan if step.tool not in tool_names]
+            if unknown_tools:
+                log.warning("Not caching the mission plan, it calls unknown tools: %s", unknown_tools)
+            else:
+                with shelve.open(PLAN_CACHE_PATH) as cache:
+                    cache[cache_key] = [list(step) for step in mission_plan]
+    except Exception as e:
+        log.error("❌ Error: LLM request failed while streaming the mission plan: %s", e)
+    finally:
+        plan_queue.put_nowait(None)
+
+
+def queue_mission_plan(mission_plan: List[Step]) -> asyncio.Queue:
+    """Wraps an already complete mission plan in a finished plan queue."""
+    plan_queue = asyncio.Queue()
+    for step in mission_plan:
+        plan_queue.put_nowait(step)
+    plan_queue.put_nowait(None)
+    return plan_queue
+
+
+async def planner_node(state: MissionState) -> Tuple[asyncio.Queue, asyncio.Task | None, str | None]:
     """
     Generates a mission plan using an improved and more detailed prompt to
     reduce hallucinations and handle a wider range of commands correctly.
+    The plan is delivered step by step through a queue while the LLM streams,
+    alongside the streaming task (None when the plan is already complete) and
+    the plan's cache key (None for fast-path plans).
     """
-    print("--- 🧠 PLANNER NODE: Generating mission plan... ---")
+    log.info("--- 🧠 PLANNER NODE: Generating mission plan... ---")
+    fast_plan_stats["total"] += 1
+    quick_plan = fast_plan(state['user_prompt'])
+    if quick_plan:
+        fast_plan_stats["hits"] += 1
+        log.info("⚡ Fast path matched (hit rate %d/%d):\n%s", fast_plan_stats["hits"], fast_plan_stats["total"], format_plan(quick_plan))
+        return queue_mission_plan(quick_plan), None, None
+
+    cache_key = plan_cache_key(state['tool_schemas'], state['user_prompt'])
+    with shelve.open(PLAN_CACHE_PATH) as cache:
+        cached_plan = to_steps(cache.get(cache_key))
+    if cached_plan:
+        log.info("⚡ Using cached mission plan:\n%s", format_plan(cached_plan))
+        return queue_mission_plan(cached_plan), None, cache_key
+
+    plan_queue = asyncio.Queue()
+
     prompt = f"""
     You are a meticulous, highly intelligent flight operations officer for an autonomous drone. 
-    Your single, critical purpose is to convert a user's freeform command into a **perfectly structured, error-free, and executable** JSON list of tool calls. You must adhere strictly to the reasoning process and tool definitions provided.
+    Your single, critical purpose is to convert a user's freeform command into a **perfectly structured, error-free, and executable** JSON object whose "plan" key holds the list of tool calls, each written as a compact `[tool_name, args]` pair. You must adhere strictly to the reasoning process and tool definitions provided.
 
     --- AVAILABLE TOOLS ---
     {state['tool_schemas']}
@@ -104,131 +346,123 @@ def planner_node(state: MissionState) -> Dict[str, Any]:
 
     5.  **Use Placeholders for Dynamic Data:** For any mission involving a named location, the `fly_to_coordinates` and `do_orbit` steps MUST use the placeholders "TARGET_LAT" and "TARGET_LON" for their `latitude` and `longitude` arguments. This is mandatory.
 
-    6.  **Construct the Final JSON:** Build the final plan as a JSON list. Ensure every step is logical and sequential (e.g., `pre_flight_check` is always first). Verify that every tool call has the correct tool name and a complete `args` dictionary.
+    6.  **Construct the Final JSON:** Build the final plan as a JSON list under the "plan" key. Ensure every step is logical and sequential (e.g., `pre_flight_check` is always first). Verify that every step is a `[tool_name, args]` pair with the correct tool name and a complete `args` dictionary.
 
     --- EXAMPLES ---
 
     **User Command 1:** "takeoff, fly 50 meters forward, then return home"
     **Your JSON Response:**
-    ```json
-    [
-      {{"tool": "pre_flight_check", "args": {{}}}},
-      {{"tool": "arm_and_takeoff", "args": {{"altitude_meters": 20}}}},
-      {{"tool": "fly_relative", "args": {{"forward_meters": 50}}}},
-      {{"tool": "return_to_launch", "args": {{}}}}
-    ]
-    ```
+    {{"plan": [
+      ["pre_flight_check", {{}}],
+      ["arm_and_takeoff", {{"altitude_meters": 20}}],
+      ["fly_relative", {{"forward_meters": 50}}],
+      ["return_to_launch", {{}}]
+    ]}}
 
     **User Command 2:** "takeoff to 30m, fly to the Eiffel Tower at 15 m/s, circle it, then land there"
     **Your JSON Response:**
-    ```json
-    [
-      {{"tool": "pre_flight_check", "args": {{}}}},
-      {{"tool": "arm_and_takeoff", "args": {{"altitude_meters": 30}}}},
-      {{"tool": "get_coordinates_for_location", "args": {{"location_name": "Eiffel Tower"}}}},
-      {{"tool": "fly_to_coordinates", "args": {{"latitude": "TARGET_LAT", "longitude": "TARGET_LON", "velocity_ms": 15}}}},
-      {{"tool": "do_orbit", "args": {{"latitude": "TARGET_LAT", "longitude": "TARGET_LON", "radius_meters": 50, "velocity_ms": 15}}}},
-      {{"tool": "land", "args": {{}}}}
-    ]
-    ```
+    {{"plan": [
+      ["pre_flight_check", {{}}],
+      ["arm_and_takeoff", {{"altitude_meters": 30}}],
+      ["get_coordinates_for_location", {{"location_name": "Eiffel Tower"}}],
+      ["fly_to_coordinates", {{"latitude": "TARGET_LAT", "longitude": "TARGET_LON", "velocity_ms": 15}}],
+      ["do_orbit", {{"latitude": "TARGET_LAT", "longitude": "TARGET_LON", "radius_meters": 50, "velocity_ms": 15}}],
+      ["land", {{}}]
+    ]}}
     --- END EXAMPLES ---
 
-    Now, generate the complete and executable JSON plan for the following user command. Respond ONLY with the JSON list inside a markdown block.
+    Now, generate the complete and executable JSON plan for the following user command. Respond ONLY with the JSON object.
 
     User Command: "{state['user_prompt']}"
     """
-    response = LLM.invoke(prompt)
-    mission_plan = extract_json_from_string(response.content)
-    if not mission_plan: 
-        print("❌ Error: LLM failed to generate a valid mission plan.")
-        print(f"LLM Raw Output:\n{response.content}")
-    else: 
-        print(f"✅ Generated Mission Plan:\n{json.dumps(mission_plan, indent=2)}")
-    return {"mission_plan": mission_plan}
+    task = asyncio.create_task(stream_mission_plan(prompt, plan_queue, cache_key, state['tool_names']))
+    _planner_tasks.add(task)
+    task.add_done_callback(_planner_tasks.discard)
+    return plan_queue, task, cache_key
 
 
-def prepare_tool_call_node(state: MissionState) -> Dict[str, Any]:
+async def call_tool(tool: BaseTool, tool_args: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Node 2: Prepare Tool Call.
-    This node is now more robust. It not only substitutes placeholders but also
-    injects necessary coordinates if the LLM forgot to include them in the plan.
+    Invokes an MCP tool and decodes its JSON result. Failures are returned as an
+    Error result rather than raised, so the mission loop handles them uniformly.
     """
-    print("--- ⚙️ PREPARING TOOL CALL NODE (Robust Version) ---")
-    plan = state["mission_plan"]
-    index = state["current_step_index"]
-    
-    step = plan[index]
-    tool_name = step["tool"]
-    tool_args = step.get("args", {}).copy()
-
-    
-    # Check if we have stored location details from a previous step.
-    if state.get("target_location_details"):
-        coords = state["target_location_details"]
-        
-        # If the current tool is one that requires coordinates, we forcefully
-        # add/overwrite them. This makes the system resilient to the LLM
-        # forgetting to add the "TARGET_LAT" placeholders in the plan.
-        if tool_name in ["fly_to_coordinates", "do_orbit"]:
-            print(f"Injecting/overwriting coordinates for '{tool_name}'...")
-            tool_args["latitude"] = coords["latitude"]
-            tool_args["longitude"] = coords["longitude"]
-
-    print(f"Executing Step {index + 1}/{len(plan)}: Calling '{tool_name}' with args {tool_args}")
-    
-    return {
-        "messages": [
-            AIMessage(
-                content="", 
-                tool_calls=[{"id": f"call_{index}", "name": tool_name, "args": tool_args}]
-            )
-        ]
-    }
-
-
-def decide_next_step_node(state: MissionState) -> Dict[str, Any]:
-    print("--- 🤔 DECIDE NEXT STEP NODE (Safety Check) ---")
-    last_tool_message = state["messages"][-1]
-    if isinstance(last_tool_message, ToolMessage):
-        is_error = getattr(last_tool_message, 'status', None) == 'error'
-        if is_error or '"status": "Error"' in last_tool_message.content:
-            error_message = f"Mission failed at step {state['current_step_index'] + 1} ('{last_tool_message.name}'). Reason: {last_tool_message.content}"
-            print(f"\n❌ CRITICAL ERROR: {error_message}\n")
-            return {}
-    updates = {}
-    if "target_location_details" in state and state["target_location_details"]:
-        updates["target_location_details"] = state["target_location_details"]
-    if isinstance(last_tool_message, ToolMessage) and last_tool_message.name == "get_coordinates_for_location":
-        try:
-            result = json.loads(last_tool_message.content)
-            if result.get("status") == "Success":
-                print(f"✅ Storing location details: {result}")
-                updates["target_location_details"] = result
-        except (json.JSONDecodeError, KeyError):
-            pass
-    new_index = state["current_step_index"] + 1
-    updates["current_step_index"] = new_index
-    print(f"✅ Step successful. Advancing to step index {new_index}")
-    return updates
-
-def should_plan_or_end(state: MissionState) -> str:
-    print("--- Router: Should Plan? ---")
-    if state.get("mission_plan"): return "prepare_tool_call"
-    else:
-        print("No mission plan generated. Ending.")
-        return END
-
-def should_continue_or_end(state: MissionState) -> str:
-    print("--- Router: Should Continue? ---")
-    last_message = state["messages"][-1]
-    is_error = getattr(last_message, 'status', None) == 'error'
-    if is_error or ('"status": "Error"' in getattr(last_message, 'content', '')):
-        return END
-    if state["current_step_index"] >= len(state["mission_plan"]):
-        print("🎉 Mission plan fully executed. Ending.")
-        return END
+    try:
+        content = await tool.ainvoke(tool_args)
+    except Exception as e:
+        return {"status": "Error", "message": f"Tool '{tool.name}' failed: {e}"}
+    try:
+        return orjson.loads(content)
+    except (orjson.JSONDecodeError, TypeError):
+        return {"message": str(content)}
+
+
+async def run_step(
+    tool_name: str, tool_args: Dict[str, Any], tools_by_name: Dict[str, BaseTool], cache_key: str | None
+) -> Dict[str, Any]:
+    """Runs one plan step. A plan that calls an unknown tool is dropped from the plan cache."""
+    if tool_name in tools_by_name:
+        return await call_tool(tools_by_name[tool_name], tool_args)
+    if cache_key:
+        forget_cached_plan(cache_key)
+    return {"status": "Error", "message": f"Unknown tool '{tool_name}'."}
+
+
+async def execute_mission_plan(
+    plan_queue: asyncio.Queue, tools_by_name: Dict[str, BaseTool], prefetched_check: asyncio.Task | None = None,
+    cache_key: str | None = None,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Executes mission steps in order as they arrive from the planner and yields
+    each tool name with its result. Coordinates from a successful geocoding step
+    are injected into later flight steps, and execution stops at the first error.
+    """
+    target_location_details = {}
+    index = 0
+    try:
+        while (step := await plan_queue.get()) is not None:
+            tool_name = step.tool
+            tool_args = step.args.copy()
+
+            # If the current tool is one that requires coordinates, we forcefully
+            # add/overwrite them. This makes the system resilient to the LLM
+            # forgetting to add the "TARGET_LAT" placeholders in the plan.
+            if target_location_details and tool_name in ["fly_to_coordinates", "do_orbit"]:
+                log.info("Injecting/overwriting coordinates for '%s'...", tool_name)
+                tool_args["latitude"] = target_location_details["latitude"]
+                tool_args["longitude"] = target_location_details["longitude"]
+
+            log.info("Executing Step %d: Calling '%s' with args %s", index + 1, tool_name, tool_args)
+            if index == 0 and prefetched_check:
+                if tool_name == "pre_flight_check":
+                    log.info("⚡ Using speculative pre-flight check result.")
+                    result = await prefetched_check
+                else:
+                    # The plan does not open with the check, so the speculative result is never used.
+                    # Wait for it to stop so it cannot overlap with step 0 on the drone link.
+                    prefetched_check.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await prefetched_check
+                    result = await run_step(tool_name, tool_args, tools_by_name, cache_key)
+            else:
+                result = await run_step(tool_name, tool_args, tools_by_name, cache_key)
+            yield tool_name, result
+
+            if result.get("status") == "Error":
+                log.error("❌ CRITICAL ERROR: Mission failed at step %d ('%s'). Reason: %s", index + 1, tool_name, result.get("message"))
+                return
+            if tool_name == "get_coordinates_for_location" and result.get("status") == "Success":
+                log.info("✅ Storing location details: %s", result)
+                target_location_details = result
+            index += 1
+    finally:
+        # The speculative check is wasted if the plan did not start with it or never got that far
+        if prefetched_check and not prefetched_check.done():
+            prefetched_check.cancel()
+
+    if index == 0:
+        log.info("No mission plan generated. Ending.")
     else:
-        return "prepare_tool_call"
+        log.info("🎉 Mission plan fully executed. Ending.")
 
 async def run_mission():
     
@@ -238,76 +472,68 @@ async def run_mission():
     client = MultiServerMCPClient({
         "PX4DroneControlServer": {"command": "python3", "args": ["drone_server.py"], "transport": "stdio"}
     })
-    print("Loading tools from MCP server...")
-    tools = await client.get_tools()
-    executor_node = ToolNode(tools)
-    print(f"✅ Tools loaded: {[tool.name for tool in tools]}")
-    
-    # Define and compile the graph (same as before)
-    workflow = StateGraph(MissionState)
-    workflow.add_node("planner", planner_node)
-    workflow.add_node("prepare_tool_call", prepare_tool_call_node)
-    workflow.add_node("executor", executor_node)
-    workflow.add_node("decide_next_step", decide_next_step_node)
-    workflow.set_entry_point("planner")
-    workflow.add_conditional_edges("planner", should_plan_or_end)
-    workflow.add_edge("prepare_tool_call", "executor")
-    workflow.add_edge("executor", "decide_next_step")
-    workflow.add_conditional_edges("decide_next_step", should_continue_or_end)
-    app = workflow.compile()
+    # One long-lived session keeps a single server process, with its drone link, telemetry
+    # subscriptions and HTTP client, alive for every tool call instead of one per call.
+    async with client.session("PX4DroneControlServer") as session:
+        log.info("Loading tools from MCP server...")
+        tools = await load_mcp_tools(session)
+        tools_by_name = {tool.name: tool for tool in tools}
+        log.info("✅ Tools loaded: %s", list(tools_by_name))
+        tool_schemas = format_tools_for_prompt(tools)
     
+        loop = asyncio.get_running_loop()
+        # Dedicated single-thread pools so speech output and voice input never queue behind each other
+        tts_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+        stt_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stt")
        
-    await asyncio.to_thread(speaker.say, "Drone assistant is ready. Please state your mission.")
+        await loop.run_in_executor(tts_pool, speaker.say, "Drone assistant is ready. Please state your mission.")
     
-    while True:
-        # Listen for a command in a separate thread to avoid blocking
-        user_command = await asyncio.to_thread(listen_for_command)
-
-        if user_command:
-            if "quit" in user_command or "exit" in user_command:
-                await asyncio.to_thread(speaker.say, "Shutting down. Goodbye.")
-                break
+        while True:
+            # Listen for a command in a separate thread to avoid blocking
+            user_command = await loop.run_in_executor(stt_pool, listen_for_command)
+
+            if user_command:
+                if "quit" in user_command or "exit" in user_command:
+                    await loop.run_in_executor(tts_pool, speaker.say, "Shutting down. Goodbye.")
+                    break
                 
-            await asyncio.to_thread(speaker.say, "Understood. Planning the mission now.")
-
-            initial_state = {
-                "user_prompt": user_command,
-                "current_step_index": 0,
-                "messages": [],
-                "target_location_details": {},
-                "tool_schemas": format_tools_for_prompt(tools),
-            }
-
-            mission_successful = True
-            async for event in app.astream(initial_state):
-                print("\n" + "="*50)
-                for key, value in event.items():
-                    print(f"## Node '{key}' Ran ##")
-                    print(value)
-                    
-                    if key == "executor":
-                        last_message = value['messages'][-1]
-                        is_error = getattr(last_message, 'status', None) == 'error' or '"status": "Error"' in last_message.content
-                        if is_error:
-                            mission_successful = False
-                            await asyncio.to_thread(speaker.say, f"An error occurred during the {last_message.name} step.")
-                        else:
-                            try:
-                                result_data = json.loads(last_message.content)
-                                status_message = result_data.get("message", "step completed.")
-                                await asyncio.to_thread(speaker.say, f"Step {last_message.name} successful. {status_message}")
-                            except json.JSONDecodeError:
-                                await asyncio.to_thread(speaker.say, f"Step {last_message.name} completed.")
-                print("="*50 + "\n")
+                # Speak while the planner runs, and speculatively start the pre-flight check,
+                # which is read-only and almost always the first step of a plan.
+                planning_announcement = loop.run_in_executor(tts_pool, speaker.say, "Understood. Planning the mission now.")
+                prefetched_check = None
+                if "pre_flight_check" in tools_by_name:
+                    prefetched_check = asyncio.create_task(call_tool(tools_by_name["pre_flight_check"], {}))
+
+                plan_queue, planner_task, cache_key = await planner_node(
+                    {"user_prompt": user_command, "tool_schemas": tool_schemas, "tool_names": set(tools_by_name)}
+                )
+
+                mission_successful = True
+                async for tool_name, result in execute_mission_plan(plan_queue, tools_by_name, prefetched_check, cache_key):
+                    log.debug("## Step '%s' Ran ##\n%s", tool_name, result)
+                    if result.get("status") == "Error":
+                        mission_successful = False
+                        await loop.run_in_executor(tts_pool, speaker.say, f"An error occurred during the {tool_name} step.")
+                    else:
+                        status_message = result.get("message", "step completed.")
+                        await loop.run_in_executor(tts_pool, speaker.say, f"Step {tool_name} successful. {status_message}")
+
+                await planning_announcement
+                if planner_task and not planner_task.done():
+                    # The mission aborted before the plan finished streaming; stop the LLM and skip caching.
+                    planner_task.cancel()
             
-            if mission_successful:
-                await asyncio.to_thread(speaker.say, "Mission completed successfully.")
+                if mission_successful:
+                    await loop.run_in_executor(tts_pool, speaker.say, "Mission completed successfully.")
+                else:
+                    await loop.run_in_executor(tts_pool, speaker.say, "Mission was aborted due to an error.")
             else:
-                await asyncio.to_thread(speaker.say, "Mission was aborted due to an error.")
-        else:
-            await asyncio.to_thread(speaker.say, "I didn't catch that. Please try again.")
+                await loop.run_in_executor(tts_pool, speaker.say, "I didn't catch that. Please try again.")
         
-        await asyncio.to_thread(speaker.say, "I am ready for the next mission command.")
+            await loop.run_in_executor(tts_pool, speaker.say, "I am ready for the next mission command.")
+
+        tts_pool.shutdown()
+        stt_pool.shutdown()
 
 
 
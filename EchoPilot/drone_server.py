@@ -1,18 +1,59 @@
 import asyncio
 import httpx
+import logging
+import logging.handlers
 import math
+import shelve
+import sys
+import time
+import numpy as np
+import orjson
 from mcp.server.fastmcp import FastMCP
 from mavsdk import System
 from mavsdk.action import ActionError, OrbitYawBehavior
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional; without it the helpers below run as plain Python.
+    def njit(**kwargs):
+        return lambda func: func
+
 # ==============================================================================
 # == Global Objects and Helpers
 # ==============================================================================
+# stdout carries the MCP stdio protocol, so all logging goes to stderr. Anything at INFO or
+# above flushes immediately, so only the per-tick DEBUG records from the flight-control loops
+# are buffered and written in batches.
+log = logging.getLogger("drone")
+log.setLevel(logging.DEBUG)
+log.addHandler(logging.handlers.MemoryHandler(capacity=100, flushLevel=logging.INFO, target=logging.StreamHandler(sys.stderr)))
+log.propagate = False
+
 mcp = FastMCP("PX4DroneControlServer")
 drone = System()
 is_drone_connected = False
-
-
+ARRIVAL_THRESHOLD_METERS = 5.0
+# Arrival checks poll more often as the ETA shrinks, but never sleep longer than this.
+MAX_ARRIVAL_POLL_S = 2.0
+# The speed command is only re-sent if the distance has not shrunk for this long.
+NO_PROGRESS_RESEND_S = 5.0
+# Re-sent speed commands are also rate-limited so they never crowd the MAVLink command queue.
+HEARTBEAT_MIN_INTERVAL_S = 10.0
+
+# Geocoding results are persisted on disk and requests share one connection pool.
+GEO_CACHE_PATH = "geo_cache.db"
+geo_cache = shelve.open(GEO_CACHE_PATH)
+# Created in main() and kept alive for the server's lifetime, so TCP/TLS sessions are reused.
+http_client: httpx.AsyncClient | None = None
+# Nominatim's usage policy allows at most one request per second. The last request time is
+# stored with the geocoding cache so the spacing also holds across server restarts.
+NOMINATIM_MIN_INTERVAL_S = 1.0
+NOMINATIM_LAST_REQUEST_KEY = "__last_nominatim_request__"
+nominatim_lock = asyncio.Lock()
+
+
+@njit(cache=True, fastmath=True)
 def get_distance_metres(lat1, lon1, lat2, lon2):
     R = 6371e3
     phi1 = math.radians(lat1); phi2 = math.radians(lat2)
@@ -22,6 +63,102 @@ def get_distance_metres(lat1, lon1, lat2, lon2):
     return R * c
 
 
+@njit(cache=True, fastmath=True)
+def relative_to_latlon(lat, lon, heading_deg, forward_meters, right_meters):
+    earth_radius = 6378137.0
+    heading = math.radians(heading_deg)
+    cos_heading = math.cos(heading); sin_heading = math.sin(heading)
+    cos_lat = math.cos(math.radians(lat))
+    # Calculate offset in radians
+    lat_offset = (forward_meters * cos_heading - right_meters * sin_heading) / earth_radius
+    lon_offset = (forward_meters * sin_heading + right_meters * cos_heading) / (earth_radius * cos_lat)
+    # Convert radians to degrees and add to current position
+    return lat + math.degrees(lat_offset), lon + math.degrees(lon_offset)
+
+
+class TelemetryHub:
+    """
+    Keeps the latest position, heading and armed state from long-lived MAVSDK
+    telemetry subscriptions, so tools read a shared sample instead of opening
+    a new stream every time they need one.
+    """
+    def __init__(self):
+        self.pos = None
+        self.heading = None
+        self.armed = None
+        self.pos_updated = asyncio.Event()
+        self.heading_updated = asyncio.Event()
+        self.armed_updated = asyncio.Event()
+        self._ended = set()
+        self._tasks = []
+
+    def start(self, system):
+        self._tasks = [
+            asyncio.create_task(self._subscribe("pos", system.telemetry.position())),
+            asyncio.create_task(self._subscribe("heading", system.telemetry.heading())),
+            asyncio.create_task(self._subscribe("armed", system.telemetry.armed())),
+        ]
+
+    async def stop(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _subscribe(self, name, stream):
+        updated = getattr(self, f"{name}_updated")
+        try:
+            async for sample in stream:
+                setattr(self, name, sample)
+                updated.set()
+        except Exception as e:
+            log.error("-- Telemetry stream '%s' failed: %s", name, e)
+        finally:
+            # The stream has closed or failed; wake any waiters so they can report lost telemetry.
+            self._ended.add(name)
+            updated.set()
+
+    async def latest(self, name):
+        """Returns the most recent sample, waiting only if none has arrived yet."""
+        if name in self._ended: raise StopAsyncIteration
+        if getattr(self, name) is None:
+            await getattr(self, f"{name}_updated").wait()
+        if name in self._ended or getattr(self, name) is None: raise StopAsyncIteration
+        return getattr(self, name)
+
+    async def fresh(self, name):
+        """Waits for the next sample to arrive and returns it."""
+        if name in self._ended: raise StopAsyncIteration
+        updated = getattr(self, f"{name}_updated")
+        updated.clear()
+        await updated.wait()
+        if name in self._ended: raise StopAsyncIteration
+        return getattr(self, name)
+
+    async def wait_next(self, name, timeout):
+        """Waits up to timeout seconds for the next sample, then returns the most recent one."""
+        if name in self._ended: raise StopAsyncIteration
+        updated = getattr(self, f"{name}_updated")
+        updated.clear()
+        try:
+            await asyncio.wait_for(updated.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        return await self.latest(name)
+
+
+telemetry = TelemetryHub()
+
+
+def get_distance_metres_batch(lat1, lon1, lats, lons):
+    """Vectorized get_distance_metres from one point to arrays of points, in a single NumPy pass."""
+    R = 6371e3
+    phi1 = math.radians(lat1); cos_phi1 = math.cos(phi1)
+    phi2 = np.radians(lats)
+    delta_phi = phi2 - phi1; delta_lambda = np.radians(lons - lon1)
+    a = np.sin(delta_phi / 2)**2 + cos_phi1 * np.cos(phi2) * np.sin(delta_lambda / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
 # ==============================================================================
 # == MCP Server Tool Definitions (More Robust and Better Docstrings)
 # ==============================================================================
@@ -37,14 +174,14 @@ async def pre_flight_check() -> dict:
     Returns: dict: A JSON object with "status" and "message".
     """
     if not is_drone_connected: return {"status": "Error", "message": "Drone is not connected."}
-    print("Performing pre-flight checks...")
+    log.info("Performing pre-flight checks...")
     try:
         async for health in drone.telemetry.health():
             if health.is_global_position_ok and health.is_home_position_ok and health.is_armable:
-                print("-- Drone is armable. All pre-flight checks passed.")
+                log.info("-- Drone is armable. All pre-flight checks passed.")
                 return {"status": "Success", "message": "All pre-flight checks passed. Drone is armable."}
             if not health.is_armable:
-                print("-- Pre-flight check failed: Drone is not in an armable state.")
+                log.warning("-- Pre-flight check failed: Drone is not in an armable state.")
                 break 
         return {"status": "Error", "message": "Pre-flight checks failed. Drone is not armable. Check sensors/calibration."}
     except asyncio.TimeoutError: return {"status": "Error", "message": "Pre-flight check timed out."}
@@ -63,19 +200,21 @@ async def arm_and_takeoff(altitude_meters: float) -> dict:
     
     if not is_drone_connected: return {"status": "Error", "message": "Drone is not connected."}
     try:
-        print("-- Arming drone...")
+        log.info("-- Arming drone...")
         await drone.action.arm()
         await asyncio.sleep(1)
-        print(f"-- Taking off to {altitude_meters} meters...")
+        log.info("-- Taking off to %s meters...", altitude_meters)
         await drone.action.set_takeoff_altitude(altitude_meters)
         await drone.action.takeoff()
-        print(f"-- Monitoring altitude... Target: {altitude_meters}m")
-        async for position in drone.telemetry.position():
+        log.info("-- Monitoring altitude... Target: %sm", altitude_meters)
+        while True:
+            position = await telemetry.fresh("pos")
             if position.relative_altitude_m >= altitude_meters * 0.95:
-                print(f"-- Target altitude of {altitude_meters}m reached!")
+                log.info("-- Target altitude of %sm reached!", altitude_meters)
                 break
         return {"status": "Success", "message": "Arm and takeoff successful."}
     except ActionError as e: return {"status": "Error", "message": f"Arm/Takeoff failed: {e}"}
+    except StopAsyncIteration: return {"status": "Error", "message": "Telemetry lost during takeoff."}
 
 
 @mcp.tool()
@@ -89,15 +228,26 @@ async def get_coordinates_for_location(location_name: str) -> dict:
     Returns: dict: A JSON object with "status", "latitude", "longitude", and "address".
     """
   
+    cache_key = location_name.strip().lower()
+    if cache_key in geo_cache:
+        log.info("-- Using cached coordinates for '%s'.", location_name)
+        return geo_cache[cache_key]
+
     url = f"https://nominatim.openstreetmap.org/search?q={location_name.replace(' ', '+')}&format=json&limit=1"
-    headers = {'User-Agent': 'DroneControlMCP/1.0'}
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=10.0)
-            response.raise_for_status()
-            data = response.json()
-            if data: return {"status": "Success", "latitude": float(data[0]["lat"]), "longitude": float(data[0]["lon"]), "address": data[0]["display_name"]}
-            return {"status": "Error", "message": f"Could not find coordinates for '{location_name}'."}
+        async with nominatim_lock:
+            last_request = geo_cache.get(NOMINATIM_LAST_REQUEST_KEY, 0.0)
+            wait_time = min(NOMINATIM_MIN_INTERVAL_S - (time.time() - last_request), NOMINATIM_MIN_INTERVAL_S)
+            if wait_time > 0: await asyncio.sleep(wait_time)
+            geo_cache[NOMINATIM_LAST_REQUEST_KEY] = time.time()
+            response = await http_client.get(url)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        if data:
+            result = {"status": "Success", "latitude": float(data[0]["lat"]), "longitude": float(data[0]["lon"]), "address": data[0]["display_name"]}
+            geo_cache[cache_key] = result
+            return result
+        return {"status": "Error", "message": f"Could not find coordinates for '{location_name}'."}
     except Exception as e: return {"status": "Error", "message": f"Geocoding or network request failed: {e}"}
 
 
@@ -122,41 +272,94 @@ async def fly_to_coordinates(latitude: float, longitude: float, altitude_meters:
     final_altitude = altitude_meters
     if final_altitude is None:
         try:
-            position = await drone.telemetry.position().__anext__()
+            position = await telemetry.latest("pos")
             final_altitude = position.absolute_altitude_m
         except StopAsyncIteration: return {"status": "Error", "message": "Failed to get current altitude."}
     
-    print(f"-- Flying to {latitude}, {longitude} at {speed_to_use} m/s...")
+    log.info("-- Flying to %s, %s at %s m/s...", latitude, longitude, speed_to_use)
     try:
         # Set speed for this specific flight leg
         await drone.action.set_current_speed(speed_to_use)
         await drone.action.goto_location(latitude, longitude, final_altitude, 0)
         
-        arrival_threshold_meters = 5.0
+        poll_interval = 0.0
+        closest_distance = float("inf")
+        last_progress_time = last_heartbeat_time = time.monotonic()
         while True:
-            await asyncio.sleep(2)
             try:
-                # Heartbeat ping
-                print("-- Sending heartbeat ping to drone...")
-                await drone.action.set_current_speed(speed_to_use)
-                
-                current_pos = await drone.telemetry.position().__anext__()
+                # Wake on the next position sample, but never later than a quarter of the ETA
+                current_pos = await telemetry.wait_next("pos", poll_interval)
                 distance_to_target = get_distance_metres(current_pos.latitude_deg, current_pos.longitude_deg, latitude, longitude)
-                print(f"-- Distance to target: {distance_to_target:.2f} meters...")
+                log.debug("-- Distance to target: %.2f meters...", distance_to_target)
                 
-                if distance_to_target < arrival_threshold_meters:
-                    print("-- Arrived at target location!")
+                if distance_to_target < ARRIVAL_THRESHOLD_METERS:
+                    log.info("-- Arrived at target location!")
                     break
+
+                # Heartbeat ping, only when the drone has stopped closing in on the target
+                if distance_to_target < closest_distance:
+                    closest_distance = distance_to_target
+                    last_progress_time = time.monotonic()
+                elif (time.monotonic() - last_progress_time > NO_PROGRESS_RESEND_S
+                      and time.monotonic() - last_heartbeat_time > HEARTBEAT_MIN_INTERVAL_S):
+                    await drone.action.set_current_speed(speed_to_use)
+                    last_progress_time = last_heartbeat_time = time.monotonic()
+
+                # Poll more often as the ETA shrinks so arrival is not overslept
+                eta = max(distance_to_target / speed_to_use, 0.1)
+                poll_interval = min(eta * 0.25, MAX_ARRIVAL_POLL_S)
             except StopAsyncIteration: 
                 return {"status": "Error", "message": "Telemetry lost during flight."}
 
-        print("-- Arrived. Stabilizing for 2 seconds...")
+        log.info("-- Arrived. Stabilizing for 2 seconds...")
         await asyncio.sleep(2)
         return {"status": "Success", "message": "Navigation successful and arrival confirmed."}
     except ActionError as e:
         return {"status": "Error", "message": f"Goto location failed: {e}"}
     
 
+@mcp.tool()
+async def fly_waypoints(latitudes: list[float], longitudes: list[float], altitude_meters: float | None = None, velocity_ms: float | None = None) -> dict:
+    """
+    Flies the drone through a sequence of GPS waypoints in order. Waits for arrival at each waypoint before continuing.
+
+    Args:
+        latitudes (list[float]): The waypoint latitudes, in flight order.
+        longitudes (list[float]): The waypoint longitudes, one for each latitude.
+        altitude_meters (float, optional): The target absolute altitude (AMSL) for every leg. If not provided, maintains current altitude.
+        velocity_ms (float, optional): The speed for every leg in m/s. If not provided, a default speed of 5.0 m/s will be used.
+
+    Returns: dict: A JSON object with "status" confirming arrival at the final waypoint.
+    """
+    if not is_drone_connected: return {"status": "Error", "message": "Drone is not connected."}
+    if not latitudes or len(latitudes) != len(longitudes):
+        return {"status": "Error", "message": "Latitudes and longitudes must be non-empty lists of the same length."}
+
+    lats = np.asarray(latitudes, dtype=np.float64)
+    lons = np.asarray(longitudes, dtype=np.float64)
+    log.info("-- Flying through %d waypoints...", len(lats))
+    index = 0
+    while index < len(lats):
+        try:
+            position = await telemetry.latest("pos")
+        except StopAsyncIteration: return {"status": "Error", "message": "Telemetry lost during flight."}
+
+        # Check every remaining waypoint at once and skip the ones the drone is already at.
+        distances = get_distance_metres_batch(position.latitude_deg, position.longitude_deg, lats[index:], lons[index:])
+        pending = np.flatnonzero(distances >= ARRIVAL_THRESHOLD_METERS)
+        if pending.size == 0:
+            break
+        index += int(pending[0])
+
+        log.debug("-- Waypoint %d/%d: %.2f meters away.", index + 1, len(lats), distances[pending[0]])
+        result = await fly_to_coordinates(float(lats[index]), float(lons[index]), altitude_meters, velocity_ms)
+        if result["status"] != "Success":
+            return {"status": "Error", "message": f"Waypoint {index + 1} failed: {result['message']}"}
+        index += 1
+
+    return {"status": "Success", "message": f"All {len(lats)} waypoints reached."}
+
+
 @mcp.tool()
 async def fly_relative(forward_meters: float = 0, right_meters: float = 0, down_meters: float = 0) -> dict:
     """
@@ -173,27 +376,22 @@ async def fly_relative(forward_meters: float = 0, right_meters: float = 0, down_
     if not is_drone_connected:
         return {"status": "Error", "message": "Drone is not connected."}
 
-    print(f"-- Flying relative: {forward_meters}m forward, {right_meters}m right, {down_meters}m down...")
+    log.info("-- Flying relative: %sm forward, %sm right, %sm down...", forward_meters, right_meters, down_meters)
     
     try:
         # Get the current position and heading
-        position = await drone.telemetry.position().__anext__()
-        heading_deg = await drone.telemetry.heading().__anext__()
+        position = await telemetry.latest("pos")
+        heading_deg = await telemetry.latest("heading")
 
         # Simple trigonometry to calculate the new GPS coordinate
-        earth_radius = 6378137.0
-        # Calculate offset in radians
-        lat_offset = (forward_meters * math.cos(math.radians(heading_deg.heading_deg)) - right_meters * math.sin(math.radians(heading_deg.heading_deg))) / earth_radius
-        lon_offset = (forward_meters * math.sin(math.radians(heading_deg.heading_deg)) + right_meters * math.cos(math.radians(heading_deg.heading_deg))) / (earth_radius * math.cos(math.radians(position.latitude_deg)))
-
-        # Convert radians to degrees and add to current position
-        new_latitude = position.latitude_deg + math.degrees(lat_offset)
-        new_longitude = position.longitude_deg + math.degrees(lon_offset)
+        new_latitude, new_longitude = relative_to_latlon(
+            position.latitude_deg, position.longitude_deg, heading_deg.heading_deg, float(forward_meters), float(right_meters)
+        )
         
         # Adjust altitude
         new_altitude = position.absolute_altitude_m - down_meters
 
-        print(f"-- Calculated new target: Lat {new_latitude}, Lon {new_longitude}")
+        log.info("-- Calculated new target: Lat %s, Lon %s", new_latitude, new_longitude)
 
         # Reuse the robust goto_location logic to fly to the new point
         # You can call other async functions directly
@@ -220,9 +418,9 @@ async def do_orbit(latitude: float, longitude: float, radius_meters: float, velo
     
     speed_to_use = velocity_ms if velocity_ms is not None else 5.0
 
-    print(f"-- Initiating orbit at {speed_to_use} m/s...")
+    log.info("-- Initiating orbit at %s m/s...", speed_to_use)
     try:
-        position = await drone.telemetry.position().__anext__()
+        position = await telemetry.latest("pos")
         absolute_altitude_m = position.absolute_altitude_m
         
         # Start the orbit action
@@ -237,10 +435,10 @@ async def do_orbit(latitude: float, longitude: float, radius_meters: float, velo
         
         
         orbit_duration = 60  # You can change this to any duration you want    
-        print(f"-- Orbiting for a fixed duration of {orbit_duration} seconds.")
+        log.info("-- Orbiting for a fixed duration of %s seconds.", orbit_duration)
         await asyncio.sleep(orbit_duration)
         
-        print("-- Orbit time complete. Holding position to stabilize...")
+        log.info("-- Orbit time complete. Holding position to stabilize...")
         await drone.action.hold()
         await asyncio.sleep(2)
         
@@ -258,16 +456,18 @@ async def land() -> dict:
     """
     
     if not is_drone_connected: return {"status": "Error", "message": "Drone is not connected."}
-    print("-- Landing command issued...")
+    log.info("-- Landing command issued...")
     try:
         await drone.action.land()
-        print("-- Monitoring for landing completion...")
-        async for is_armed in drone.telemetry.armed():
+        log.info("-- Monitoring for landing completion...")
+        while True:
+            is_armed = await telemetry.fresh("armed")
             if not is_armed:
-                print("-- Landing and disarm confirmed!")
+                log.info("-- Landing and disarm confirmed!")
                 break
         return {"status": "Success", "message": "Landing successful."}
     except ActionError as e: return {"status": "Error", "message": f"Landing failed: {e}"}
+    except StopAsyncIteration: return {"status": "Error", "message": "Telemetry lost during landing."}
 
 @mcp.tool()
 async def return_to_launch() -> dict:
@@ -279,35 +479,49 @@ async def return_to_launch() -> dict:
     """
     
     if not is_drone_connected: return {"status": "Error", "message": "Drone is not connected."}
-    print("-- Return to Launch (RTL) command issued...")
+    log.info("-- Return to Launch (RTL) command issued...")
     try:
         await drone.action.return_to_launch()
-        print("-- Monitoring for landing completion at launch point...")
-        async for is_armed in drone.telemetry.armed():
+        log.info("-- Monitoring for landing completion at launch point...")
+        while True:
+            is_armed = await telemetry.fresh("armed")
             if not is_armed:
-                print("-- RTL landing and disarm confirmed!")
+                log.info("-- RTL landing and disarm confirmed!")
                 break
         return {"status": "Success", "message": "Return to launch successful."}
     except ActionError as e: return {"status": "Error", "message": f"RTL failed: {e}"}
+    except StopAsyncIteration: return {"status": "Error", "message": "Telemetry lost during RTL."}
 
 async def main():
     
-    global is_drone_connected
-    print("Attempting to connect to drone...")
+    global is_drone_connected, http_client
+    log.info("Attempting to connect to drone...")
     await drone.connect(system_address="udp://:14540")
     async for state in drone.core.connection_state():
         if state.is_connected:
-            print("-- Drone Connected!")
+            log.info("-- Drone Connected!")
             is_drone_connected = True
             break
     if is_drone_connected:
-        print("Starting MCP server. Awaiting commands from the model...")
-        await mcp.run_stdio_async()
+        telemetry.start(drone)
+        http_client = httpx.AsyncClient(
+            http2=True,
+            headers={'User-Agent': 'DroneControlMCP/1.0'},
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=4),
+        )
+        log.info("Starting MCP server. Awaiting commands from the model...")
+        try:
+            await mcp.run_stdio_async()
+        finally:
+            await telemetry.stop()
+            await http_client.aclose()
+            geo_cache.close()
     else:
-        print("Could not connect to the drone. MCP server will not start.")
+        log.error("Could not connect to the drone. MCP server will not start.")
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\nServer terminated by user.")
\ No newline at end of file
+        log.info("Server terminated by user.")
\ No newline at end of file
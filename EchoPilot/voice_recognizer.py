@@ -1,27 +1,144 @@
+import array
+import io
+import math
+import os
+import queue
+import threading
+import pyaudio
 import speech_recognition as sr
+import webrtcvad
 import logging
 
-def listen_for_command(timeout=5, phrase_time_limit=10):
-    """Listens for a voice command and returns it as text."""
-    recognizer = sr.Recognizer()
-    with sr.Microphone() as source:
-        print("\n" + "="*25)
+# Set ECHOPILOT_STT=google to use the online Google Web Speech API instead of local Whisper.
+USE_GOOGLE_STT = os.getenv("ECHOPILOT_STT", "whisper").lower() == "google"
+
+if not USE_GOOGLE_STT:
+    from faster_whisper import WhisperModel
+    # int8 quantization keeps the small English model fast on a CPU.
+    stt_model = WhisperModel("small.en", compute_type="int8")
+    print("🎧 Offline STT model (faster-whisper small.en, int8) loaded.")
+
+def transcribe(recognizer, audio):
+    """Converts captured audio to text with the configured speech-to-text engine."""
+    if USE_GOOGLE_STT:
+        return recognizer.recognize_google(audio)
+    segments, _ = stt_model.transcribe(io.BytesIO(audio.get_wav_data(convert_rate=16000)))
+    text = " ".join(segment.text.strip() for segment in segments)
+    if not text:
+        raise sr.UnknownValueError()
+    return text
+
+class VoiceListener:
+    """
+    Keeps the microphone open and runs webrtcvad on 20 ms frames in a background
+    thread. Complete utterances are pushed to a queue as raw 16-bit PCM, so a
+    command can be captured without reopening and recalibrating the microphone.
+    """
+    SAMPLE_RATE = 16000
+    FRAME_MS = 20
+    FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+    END_SILENCE_MS = 500
+    MIN_SPEECH_MS = 200
+    # A frame only counts as speech if it is this much louder than the calibrated noise floor.
+    NOISE_GATE_FACTOR = 1.5
+
+    def __init__(self, vad_aggressiveness=2):
+        self.utterances = queue.Queue()
+        self.listening = threading.Event()
+        self.phrase_time_limit = 10
+        # Set when the microphone stream fails; the listener thread has stopped by then.
+        self.error = None
+        self.vad = webrtcvad.Vad(vad_aggressiveness)
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(format=pyaudio.paInt16, channels=1, rate=self.SAMPLE_RATE,
+                                        input=True, frames_per_buffer=self.FRAME_SAMPLES)
         print("🎤 Calibrating... Please be quiet for a moment.")
-        recognizer.adjust_for_ambient_noise(source, duration=1)
-        print("Say your command now...")
-        print("="*25)
+        self.noise_floor = self._measure_noise_floor(duration=1)
+        threading.Thread(target=self._run, name="vad", daemon=True).start()
+
+    def _read_frame(self):
+        return self._stream.read(self.FRAME_SAMPLES, exception_on_overflow=False)
+
+    @staticmethod
+    def _rms(frame):
+        samples = array.array("h", frame)
+        return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+    def _measure_noise_floor(self, duration):
+        frame_count = int(duration * 1000 / self.FRAME_MS)
+        return sum(self._rms(self._read_frame()) for _ in range(frame_count)) / frame_count
+
+    def _is_speech(self, frame):
+        return self.vad.is_speech(frame, self.SAMPLE_RATE) and self._rms(frame) > self.noise_floor * self.NOISE_GATE_FACTOR
+
+    def _run(self):
         try:
-            audio = recognizer.listen(source, timeout=timeout, phrase_time_limit=phrase_time_limit)
-            print("✅ Audio captured, recognizing...")
-            command = recognizer.recognize_google(audio)
-            print(f"👤 YOU SAID: {command}")
-            return command.lower()
-        except sr.WaitTimeoutError:
-            print("👂 Listening timed out.")
-            return None
-        except sr.UnknownValueError:
-            print("❌ Could not understand the audio.")
-            return None
+            self._listen()
         except Exception as e:
-            logging.error(f"An unexpected error in voice recognition: {e}")
-            return None
\ No newline at end of file
+            logging.error("Voice listener stopped, microphone read failed: %s", e)
+            self.error = e
+            # Wake a pending listen_for_command so it reports the failure instead of timing out.
+            self.utterances.put(None)
+
+    def _listen(self):
+        frames, speech_ms, silence_ms = [], 0, 0
+        while True:
+            frame = self._read_frame()
+            # Audio is only kept while a command is awaited, so the drone's own voice is ignored.
+            if not self.listening.is_set():
+                frames, speech_ms, silence_ms = [], 0, 0
+                continue
+            if self._is_speech(frame):
+                frames.append(frame)
+                speech_ms += self.FRAME_MS
+                silence_ms = 0
+            elif frames:
+                frames.append(frame)
+                silence_ms += self.FRAME_MS
+            if not frames:
+                continue
+            if silence_ms > self.END_SILENCE_MS or len(frames) * self.FRAME_MS >= self.phrase_time_limit * 1000:
+                if speech_ms >= self.MIN_SPEECH_MS:
+                    self.utterances.put(b"".join(frames))
+                frames, speech_ms, silence_ms = [], 0, 0
+
+
+recognizer = sr.Recognizer()
+# Opened at import, like the STT model, so the noise floor is calibrated before the first prompt.
+voice_listener = VoiceListener()
+
+def listen_for_command(timeout=5, phrase_time_limit=10):
+    """Listens for a voice command and returns it as text."""
+    if voice_listener.error:
+        print(f"❌ Microphone unavailable: {voice_listener.error}")
+        return None
+    voice_listener.phrase_time_limit = phrase_time_limit
+    # Drop anything captured at the end of the previous listen.
+    while not voice_listener.utterances.empty():
+        voice_listener.utterances.get_nowait()
+
+    print("\n" + "="*25)
+    print("Say your command now...")
+    print("="*25)
+    voice_listener.listening.set()
+    try:
+        pcm = voice_listener.utterances.get(timeout=timeout + phrase_time_limit)
+        if pcm is None:
+            print(f"❌ Microphone unavailable: {voice_listener.error}")
+            return None
+        print("✅ Audio captured, recognizing...")
+        audio = sr.AudioData(pcm, VoiceListener.SAMPLE_RATE, 2)
+        command = transcribe(recognizer, audio)
+        print(f"👤 YOU SAID: {command}")
+        return command.lower()
+    except queue.Empty:
+        print("👂 Listening timed out.")
+        return None
+    except sr.UnknownValueError:
+        print("❌ Could not understand the audio.")
+        return None
+    except Exception as e:
+        logging.error(f"An unexpected error in voice recognition: {e}")
+        return None
+    finally:
+        voice_listener.listening.clear()